@@ -1,6 +1,10 @@
 import asyncio
 import json
 import logging
+import queue
+import random
+import threading
+import time
 from bleak import BleakScanner, BleakClient
 from bleak.exc import BleakError
 import mido
@@ -10,26 +14,88 @@ from mido import Message
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 按状态字节预先计算的MIDI消息总长度(含状态字节)
+_MESSAGE_LENGTHS = [1] * 256
+for _status in range(0x80, 0xF0):
+    _MESSAGE_LENGTHS[_status] = 2 if 0xC0 <= _status <= 0xDF else 3
+_MESSAGE_LENGTHS[0xF1] = 2
+_MESSAGE_LENGTHS[0xF2] = 3
+_MESSAGE_LENGTHS[0xF3] = 2
+del _status
+
+# 不单独转发的状态字节: SysEx结束(F7，SysEx本身由解析器跳过)与未定义的系统消息
+_UNFORWARDED = frozenset((0xF4, 0xF5, 0xF7, 0xF9, 0xFD))
+
+# 需要活动描述或改写的通道消息: (状态字节, 数据字节1, 数据字节2) -> (待发送的原始字节, 活动描述)
+# 其他完整的MIDI消息按原始字节直接转发
+def _handle_note_off(status, d1, d2):
+    return (status, d1, d2), f"Note Off: 音符 {d1}"
+
+def _handle_note_on(status, d1, d2):
+    if d2 > 0:
+        return (status, d1, d2), f"Note On: 音符 {d1} (力度: {d2})"
+    # 力度为0的Note On相当于Note Off，按Note Off转发
+    return (0x80 | (status & 0x0F), d1, 0), f"Note Off: 音符 {d1}"
+
+def _handle_control_change(status, d1, d2):
+    return (status, d1, d2), f"控制改变: {d1} = {d2}"
+
+def _handle_pitch_bend(status, d1, d2):
+    # 14位无符号值(0..16383)，显示为以8192为中心的有符号值(-8192..8191)
+    pitch = ((d2 << 7) | d1) - 8192
+    return (status, d1, d2), f"弯音: {pitch}"
+
+_DISPATCH = {
+    0x80: _handle_note_off,
+    0x90: _handle_note_on,
+    0xB0: _handle_control_change,
+    0xE0: _handle_pitch_bend,
+}
+
+# 端口列表缓存有效期(秒)，枚举MIDI驱动可能很慢
+PORT_CACHE_TTL = 2.0
+_cached_ports = []
+_cached_ports_time = None
+
+def list_output_ports(force=False):
+    """列出可用的MIDI输出端口(带短时缓存)，无需打开任何端口"""
+    global _cached_ports, _cached_ports_time
+    now = time.monotonic()
+    if not force and _cached_ports_time is not None and now - _cached_ports_time < PORT_CACHE_TTL:
+        return list(_cached_ports)
+    _cached_ports = mido.get_output_names()
+    _cached_ports_time = now
+    return list(_cached_ports)
+
 class MidiPortManager:
-    """管理MIDI输出端口"""
+    """管理MIDI输出端口 - 端口列表在首次打开端口时才枚举，构造本身不访问MIDI驱动"""
     def __init__(self):
         self.output_ports = []
         self.current_port = None
-        self.refresh_ports()
+        self._send_raw = None
     
-    def refresh_ports(self):
+    def refresh_ports(self, force=False):
         """刷新可用的MIDI输出端口"""
-        self.output_ports = mido.get_output_names()
+        self.output_ports = list_output_ports(force)
         return self.output_ports
     
     def open_port(self, port_name):
         """打开MIDI输出端口"""
         try:
+            # 端口已打开则直接复用，避免昂贵的关闭/重新打开
+            if self.current_port and not self.current_port.closed and self.current_port.name == port_name:
+                return True
+            
             if self.current_port:
                 self.current_port.close()
             
+            if port_name not in self.output_ports:
+                self.refresh_ports()
             if port_name in self.output_ports:
                 self.current_port = mido.open_output(port_name)
+                # python-rtmidi后端可直接发送原始字节，跳过mido消息对象的构造与序列化
+                rt = getattr(self.current_port, '_rt', None)
+                self._send_raw = rt.send_message if rt is not None else None
                 logger.info(f"已打开MIDI端口: {port_name}")
                 return True
             else:
@@ -50,8 +116,16 @@ class MidiPortManager:
                 return False
         return False
     
+    def send_raw(self, data):
+        """发送原始MIDI字节，非python-rtmidi后端时退回mido消息"""
+        if self._send_raw is not None:
+            self._send_raw(data)
+        else:
+            self.send_message(Message.from_bytes(data))
+    
     def close(self):
         """关闭MIDI端口"""
+        self._send_raw = None
         if self.current_port:
             self.current_port.close()
             self.current_port = None
@@ -65,18 +139,53 @@ class BleMidiBridge:
     
     def __init__(self, device_name="FP-18", midi_port_name=None, status_callback=None, activity_callback=None):
         self.device_name = device_name
+        self._device_name_ci = device_name.casefold()
         self.midi_port_name = midi_port_name
         self.status_callback = status_callback
         self.activity_callback = activity_callback
         
+        self._midi_service_uuids = [self.MIDI_SERVICE_UUID]
+        
+        self._loop = None
         self.client = None
+        self._found_device = None
+        self._found_event = None
+        self._disconnected = None
+        self._stop_event = None
         self.is_connected = False
         self.should_reconnect = True
         self.auto_reconnect = True
-        self.scan_interval = 5
+        # 重连采用指数退避+随机抖动: 1, 2, 4 ... 最长64秒
+        self.max_retry_delay = 64
+        self._retry = 0
         
         self.midi_manager = MidiPortManager()
         
+        # MIDI发送队列，由独立线程写入端口，避免阻塞BLE通知回调
+        self._tx_queue = queue.SimpleQueue()
+        self._tx_thread = threading.Thread(target=self._tx_loop, daemon=True)
+        self._tx_thread.start()
+        
+        # BLE数据接收队列，解析线程在run()中启动
+        self._rx_queue = queue.SimpleQueue()
+        self._rx_thread = None
+        
+    def _tx_loop(self):
+        """MIDI发送线程 - 从队列取出原始字节并写入当前端口"""
+        get = self._tx_queue.get
+        manager = self.midi_manager
+        send_raw = manager.send_raw
+        while True:
+            raw = get()
+            if raw is None:
+                break
+            if manager.current_port is None:
+                continue
+            try:
+                send_raw(raw)
+            except Exception as e:
+                logger.error(f"发送MIDI消息失败: {e}")
+    
     def update_status(self, message):
         """更新状态信息"""
         logger.info(message)
@@ -84,41 +193,75 @@ class BleMidiBridge:
             self.status_callback(message)
     
     def update_activity(self, message):
-        """更新MIDI活动信息"""
-        logger.info(f"MIDI活动: {message}")
+        """更新MIDI活动信息 - 每个MIDI事件都会调用，不写INFO日志"""
         if self.activity_callback:
             self.activity_callback(message)
     
+    def _on_advertisement(self, device, advertisement_data):
+        """扫描回调 - 名称匹配时记录设备并通知扫描结束"""
+        if self._found_device is None and device.name and self._device_name_ci in device.name.casefold():
+            self._found_device = device
+            self._found_event.set()
+    
+    def _on_disconnect(self, client):
+        """BLE断开回调 - 唤醒主运行循环"""
+        if self._disconnected is not None:
+            self._disconnected.set()
+    
     async def connect_to_device(self):
         """尝试连接设备"""
         device = None
         max_scan_attempts = 3
         
         for attempt in range(max_scan_attempts):
+            if not self.should_reconnect:
+                return None
             self.update_status(f"扫描设备中... (尝试 {attempt + 1}/{max_scan_attempts})")
             
+            self._found_device = None
+            self._found_event = asyncio.Event()
             try:
-                devices = await BleakScanner.discover(timeout=10.0)
-                for d in devices:
-                    if d.name and self.device_name.lower() in d.name.lower():
-                        device = d
-                        self.update_status(f"找到设备: {d.name} ({d.address})")
-                        break
+                # 在系统扫描层按MIDI服务UUID过滤，名称匹配仅用于区分多台设备
+                scanner = BleakScanner(detection_callback=self._on_advertisement,
+                                       service_uuids=self._midi_service_uuids)
+                await scanner.start()
+                try:
+                    # 找到目标设备或收到停止请求即提前结束扫描
+                    waiters = {asyncio.ensure_future(self._found_event.wait()),
+                               asyncio.ensure_future(self._stop_event.wait())}
+                    _, pending = await asyncio.wait(waiters, timeout=10.0,
+                                                    return_when=asyncio.FIRST_COMPLETED)
+                    for waiter in pending:
+                        waiter.cancel()
+                finally:
+                    await scanner.stop()
             except Exception as e:
                 logger.error(f"扫描设备时出错: {e}")
                 self.update_status(f"扫描错误: {e}")
             
+            device = self._found_device
             if device:
+                self.update_status(f"找到设备: {device.name} ({device.address})")
                 break
-            await asyncio.sleep(2)
+            if attempt + 1 < max_scan_attempts:
+                await self._wait_for_stop(min(64, 2 ** attempt))
         
         if not device:
             self.update_status(f"❌ 未找到设备: {self.device_name}")
             return None
+        if not self.should_reconnect:
+            return None
         
         try:
-            self.client = BleakClient(device.address)
+            self._disconnected = asyncio.Event()
+            # 同一地址复用已有的客户端对象，仅在设备地址变化时重新创建
+            if not (self.client and self.client.address == device.address):
+                self.client = BleakClient(device.address, disconnected_callback=self._on_disconnect)
             await self.client.connect()
+            if not self.should_reconnect:
+                # 连接过程中已被停止，不再打开MIDI端口
+                await self.client.disconnect()
+                return None
             self.is_connected = True
             self.update_status(f"✅ 已连接: {device.name}")
             
@@ -133,80 +276,139 @@ class BleMidiBridge:
             return None
     
     def midi_data_handler(self, sender, data):
-        """处理MIDI数据"""
+        """BLE通知回调 - 只把数据包放入接收队列，解析在工作线程中进行"""
+        self._rx_queue.put_nowait(bytes(data))
+    
+    def _rx_loop(self):
+        """MIDI解析线程 - 从接收队列取出数据包并解析转发"""
+        get = self._rx_queue.get
+        parse = self._parse_and_send
+        while True:
+            data = get()
+            if data is None:
+                break
+            parse(data)
+    
+    def _parse_and_send(self, data):
+        """解析BLE-MIDI数据包并转发其中的MIDI消息
+
+        BLE-MIDI数据包格式: 包头字节 + (时间戳字节 + MIDI消息)*，
+        每个状态字节前都有一个时间戳字节，省略状态字节时沿用运行状态(running status)。
+        """
         try:
-            if len(data) < 3:
+            end = len(data)
+            if end < 3 or not data[0] & 0x80:
                 return
-                
-            # 查找MIDI状态字节 (0x80-0xEF)
-            midi_data = bytearray()
-            for byte in data:
-                if byte >= 0x80 and byte <= 0xEF:
-                    if midi_data:  # 如果已经有数据，先处理之前的消息
-                        self.process_midi_message(bytes(midi_data))
-                    midi_data = bytearray([byte])
-                elif midi_data and byte < 0x80:
-                    midi_data.append(byte)
-            
-            if midi_data:
-                self.process_midi_message(bytes(midi_data))
-                
+
+            # 循环中使用局部变量，减少属性和全局名称查找
+            process = self.process_midi_message
+            lengths = _MESSAGE_LENGTHS
+            running_status = 0
+            i = 1
+            while i < end:
+                # 跳过时间戳字节
+                if data[i] & 0x80:
+                    i += 1
+                    if i >= end:
+                        break
+
+                byte = data[i]
+                if byte & 0x80:
+                    if byte == 0xF0:
+                        # SysEx: 跳过数据直到结束字节(F7前同样带时间戳)
+                        i += 1
+                        while i < end and not data[i] & 0x80:
+                            i += 1
+                        running_status = 0
+                        continue
+                    if byte < 0xF8:
+                        # 系统公共消息会清除运行状态，实时消息不影响
+                        running_status = byte if byte < 0xF0 else 0
+                    length = lengths[byte]
+                    if i + length > end:
+                        break
+                    process(byte, data, i + 1)
+                    i += length
+                elif running_status:
+                    length = lengths[running_status] - 1
+                    if i + length > end:
+                        break
+                    process(running_status, data, i)
+                    i += length
+                else:
+                    # 没有运行状态的孤立数据字节
+                    i += 1
+
         except Exception as e:
             logger.error(f"处理MIDI数据时出错: {e}")
     
-    def process_midi_message(self, data):
-        """处理MIDI消息并转发"""
+    def process_midi_message(self, status, data, offset):
+        """处理MIDI消息并转发 - 数据字节直接从数据包的offset处读取，不复制"""
         try:
-            if len(data) >= 1:
-                message_type = data[0] & 0xF0
-                
-                # 创建MIDI消息
-                if message_type == 0x80 and len(data) >= 3:  # Note Off
-                    msg = Message('note_off', note=data[1], velocity=data[2])
-                    self.midi_manager.send_message(msg)
-                    self.update_activity(f"Note Off: 音符 {data[1]}")
-                    
-                elif message_type == 0x90 and len(data) >= 3:  # Note On
-                    velocity = data[2]
-                    msg = Message('note_on', note=data[1], velocity=velocity)
-                    self.midi_manager.send_message(msg)
-                    if velocity > 0:
-                        self.update_activity(f"Note On: 音符 {data[1]} (力度: {velocity})")
-                    else:
-                        self.update_activity(f"Note Off: 音符 {data[1]}")  # 力度为0的Note On相当于Note Off
-                    
-                elif message_type == 0xB0 and len(data) >= 3:  # Control Change
-                    msg = Message('control_change', control=data[1], value=data[2])
-                    self.midi_manager.send_message(msg)
-                    self.update_activity(f"控制改变: {data[1]} = {data[2]}")
-                    
-                elif message_type == 0xE0 and len(data) >= 3:  # Pitch Bend
-                    value = (data[2] << 7) | data[1]
-                    msg = Message('pitchwheel', pitch=value)
-                    self.midi_manager.send_message(msg)
-                    self.update_activity(f"弯音: {value}")
-                
+            handler = _DISPATCH.get(status & 0xF0)
+            if handler:
+                raw, activity = handler(status, data[offset] & 0x7F, data[offset + 1] & 0x7F)
+                self._tx_queue.put_nowait(raw)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"MIDI活动: {activity}")
+                self.update_activity(activity)
+                return
+            
+            if status in _UNFORWARDED:
+                return
+            length = _MESSAGE_LENGTHS[status]
+            if length == 3:
+                raw = (status, data[offset] & 0x7F, data[offset + 1] & 0x7F)
+            elif length == 2:
+                raw = (status, data[offset] & 0x7F)
+            else:
+                raw = (status,)
+            self._tx_queue.put_nowait(raw)
         except Exception as e:
             logger.error(f"处理MIDI消息时出错: {e}")
     
+    async def _wait_for_stop(self, timeout):
+        """等待timeout秒，期间收到停止请求则立即返回"""
+        try:
+            await asyncio.wait_for(self._stop_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+    
+    async def _retry_sleep(self, action):
+        """按指数退避(带抖动)等待下一次连接"""
+        delay = min(self.max_retry_delay, 2 ** self._retry) + random.uniform(0, 1)
+        self._retry += 1
+        self.update_status(f"{delay:.1f}秒后{action}...")
+        await self._wait_for_stop(delay)
+    
     async def run(self):
         """主运行循环"""
+        self._stop_event = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        if self._rx_thread is None:
+            self._rx_thread = threading.Thread(target=self._rx_loop, daemon=True)
+            self._rx_thread.start()
         while self.should_reconnect:
             try:
                 client = await self.connect_to_device()
+                if not self.should_reconnect:
+                    break
                 if not client:
                     if self.auto_reconnect:
-                        self.update_status(f"{self.scan_interval}秒后重试连接...")
-                        await asyncio.sleep(self.scan_interval)
+                        await self._retry_sleep("重试连接")
                     continue
                 
                 # 设置MIDI特性通知
                 await client.start_notify(self.MIDI_CHARACTERISTIC_UUID, self.midi_data_handler)
+                self._retry = 0
                 self.update_status("🎹 MIDI转发已启动，开始接收数据...")
                 
-                # 保持连接状态
-                while self.should_reconnect and client.is_connected:
-                    await asyncio.sleep(1)
+                # 等待断开或停止事件，无需轮询
+                waiters = {asyncio.ensure_future(self._disconnected.wait()),
+                           asyncio.ensure_future(self._stop_event.wait())}
+                _, pending = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+                for waiter in pending:
+                    waiter.cancel()
                 
                 if client.is_connected:
                     await client.stop_notify(self.MIDI_CHARACTERISTIC_UUID)
@@ -221,17 +423,15 @@ class BleMidiBridge:
                 self.is_connected = False
             
             if self.should_reconnect and self.auto_reconnect:
-                self.update_status(f"{self.scan_interval}秒后重新连接...")
-                await asyncio.sleep(self.scan_interval)
+                await self._retry_sleep("重新连接")
     
     def stop(self):
-        """停止连接"""
+        """停止连接 - 可从其他线程调用，通过停止事件唤醒run()，由run()负责断开BLE连接"""
         self.should_reconnect = False
-        if self.client and self.client.is_connected:
-            asyncio.create_task(self.client.disconnect())
+        loop = self._loop
+        if loop and not loop.is_closed():
+            loop.call_soon_threadsafe(self._stop_event.set)
+        self._rx_queue.put_nowait(None)
+        self._tx_queue.put_nowait(None)
+        self._tx_thread.join(timeout=1.0)
         self.midi_manager.close()
-
-async def start_ble_midi_bridge(device_name, midi_port_name, status_callback, activity_callback):
-    """启动BLE MIDI桥接器"""
-    bridge = BleMidiBridge(device_name, midi_port_name, status_callback, activity_callback)
-    await bridge.run()
\ No newline at end of file
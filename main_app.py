@@ -1,35 +1,51 @@
 import sys
+import importlib.util
+
+# 检查依赖 - 必须在导入PyQt5/bleak/mido之前进行，否则缺少依赖时提示信息无法显示
+if __name__ == "__main__":
+    _missing = [name for name in ("bleak", "mido", "PyQt5") if importlib.util.find_spec(name) is None]
+    if _missing:
+        print(f"缺少依赖: {', '.join(_missing)}")
+        print("请安装: pip install bleak mido PyQt5 python-rtmidi")
+        sys.exit(1)
+
 import os
 import json
 import threading
 import time
+import collections
 import logging
-from PyQt5.QtCore import Qt, QTimer, pyqtSignal, QObject
+from PyQt5.QtCore import QTimer, pyqtSignal, QObject
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, 
                             QWidget, QLabel, QPushButton, QTextEdit, QComboBox,
                             QCheckBox, QGroupBox)
 import asyncio
-from ble_midi_client import start_ble_midi_bridge, MidiPortManager
+from ble_midi_client import BleMidiBridge, list_output_ports
 
 # 创建线程安全的信号类
 class BridgeSignals(QObject):
     status_signal = pyqtSignal(str)
-    activity_signal = pyqtSignal(str)
     log_signal = pyqtSignal(str)
+    ports_signal = pyqtSignal(list)
 
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
         self.bridge_thread = None
-        self.bridge_loop = None
+        self.bridge = None
         self.is_running = False
         self.config = self.load_config()
         
+        # 待显示的MIDI活动，由BLE线程写入、UI定时器批量取出
+        self._pending_activity = collections.deque(maxlen=256)
+        self._activity_lock = threading.Lock()
+        self._ts_cache = (0, "")
+        
         # 创建信号对象
         self.signals = BridgeSignals()
         self.signals.status_signal.connect(self.update_status_ui)
-        self.signals.activity_signal.connect(self.update_activity_ui)
         self.signals.log_signal.connect(self.update_log_ui)
+        self.signals.ports_signal.connect(self.update_ports_ui)
         
         self.init_ui()
         self.setup_logging()
@@ -82,12 +98,12 @@ class MainWindow(QMainWindow):
         midi_layout = QHBoxLayout()
         midi_layout.addWidget(QLabel("MIDI输出端口:"))
         self.midi_port_combo = QComboBox()
-        self.refresh_midi_ports()
         midi_layout.addWidget(self.midi_port_combo)
         
         self.refresh_ports_btn = QPushButton("刷新端口")
         self.refresh_ports_btn.clicked.connect(self.refresh_midi_ports)
         midi_layout.addWidget(self.refresh_ports_btn)
+        self.refresh_midi_ports()
         connection_layout.addLayout(midi_layout)
         
         # 扫描间隔设置
@@ -124,8 +140,16 @@ class MainWindow(QMainWindow):
         self.activity_text = QTextEdit()
         self.activity_text.setMaximumHeight(120)
         self.activity_text.setReadOnly(True)
+        # 由Qt内部裁剪旧行，只保留最后50行
+        self.activity_text.document().setMaximumBlockCount(50)
         status_layout.addWidget(self.activity_text)
         
+        # 约30Hz批量刷新活动记录，避免每个MIDI事件都唤醒UI线程
+        self.activity_timer = QTimer(self)
+        self.activity_timer.setInterval(33)
+        self.activity_timer.timeout.connect(self.update_activity_ui)
+        self.activity_timer.start()
+        
         layout.addWidget(status_group)
         
         # 日志组
@@ -134,6 +158,7 @@ class MainWindow(QMainWindow):
         
         self.log_text = QTextEdit()
         self.log_text.setReadOnly(True)
+        self.log_text.document().setMaximumBlockCount(200)
         log_layout.addWidget(self.log_text)
         
         layout.addWidget(log_group)
@@ -171,10 +196,22 @@ class MainWindow(QMainWindow):
         logger.addHandler(console_handler)
     
     def refresh_midi_ports(self):
-        """刷新MIDI端口列表"""
-        midi_manager = MidiPortManager()
-        ports = midi_manager.refresh_ports()
+        """刷新MIDI端口列表 - 在后台线程枚举，避免阻塞UI"""
+        self.refresh_ports_btn.setEnabled(False)
+        
+        def enumerate_ports():
+            try:
+                ports = list_output_ports()
+            except Exception as e:
+                logging.getLogger(__name__).error(f"枚举MIDI端口失败: {e}")
+                ports = []
+            self.signals.ports_signal.emit(ports)
         
+        threading.Thread(target=enumerate_ports, daemon=True).start()
+    
+    def update_ports_ui(self, ports):
+        """更新MIDI端口列表UI - 在主线程中执行"""
+        self.refresh_ports_btn.setEnabled(True)
         self.midi_port_combo.clear()
         self.midi_port_combo.addItems(ports)
         
@@ -194,7 +231,13 @@ class MainWindow(QMainWindow):
     
     def activity_callback(self, message):
         """MIDI活动回调函数 - 从BLE线程调用"""
-        self.signals.activity_signal.emit(message)
+        # 同一秒内复用已格式化的时间戳，避免每个事件都调用strftime
+        now = int(time.time())
+        if now != self._ts_cache[0]:
+            self._ts_cache = (now, time.strftime("%H:%M:%S", time.localtime(now)))
+        timestamp = self._ts_cache[1]
+        with self._activity_lock:
+            self._pending_activity.append(f"[{timestamp}] {message}")
     
     def update_status_ui(self, message):
         """更新状态UI - 在主线程中执行"""
@@ -202,14 +245,14 @@ class MainWindow(QMainWindow):
         # 自动添加到日志
         self.update_log_ui(f"状态: {message}")
     
-    def update_activity_ui(self, message):
-        """更新活动UI - 在主线程中执行"""
-        timestamp = time.strftime("%H:%M:%S")
-        self.activity_text.append(f"[{timestamp}] {message}")
-        # 限制活动记录数量
-        lines = self.activity_text.toPlainText().split('\n')
-        if len(lines) > 50:
-            self.activity_text.setPlainText('\n'.join(lines[-50:]))
+    def update_activity_ui(self):
+        """批量更新活动UI - 由定时器在主线程中执行"""
+        if not self._pending_activity:
+            return
+        with self._activity_lock:
+            lines = list(self._pending_activity)
+            self._pending_activity.clear()
+        self.activity_text.append('\n'.join(lines))
         
         # 自动滚动到底部
         cursor = self.activity_text.textCursor()
@@ -219,10 +262,6 @@ class MainWindow(QMainWindow):
     def update_log_ui(self, message):
         """更新日志UI - 在主线程中执行"""
         self.log_text.append(message)
-        # 保持最后200行
-        lines = self.log_text.toPlainText().split('\n')
-        if len(lines) > 200:
-            self.log_text.setPlainText('\n'.join(lines[-200:]))
         
         # 自动滚动到底部
         cursor = self.log_text.textCursor()
@@ -245,30 +284,38 @@ class MainWindow(QMainWindow):
             self.update_status_ui("❌ 请选择MIDI输出端口")
             return
         
+        # 在GUI线程中创建桥接器，确保此后点击停止时总能拿到它
+        try:
+            bridge = BleMidiBridge(
+                device_name=device_name,
+                midi_port_name=midi_port,
+                status_callback=self.status_callback,
+                activity_callback=self.activity_callback
+            )
+        except Exception as e:
+            self.update_status_ui(f"❌ 桥接器错误: {e}")
+            return
+        self.bridge = bridge
+        
         self.is_running = True
         self.start_btn.setEnabled(False)
         self.stop_btn.setEnabled(True)
         
         # 在单独线程中运行BLE客户端
         def run_bridge():
-            self.bridge_loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(self.bridge_loop)
+            # 事件循环只保存在本线程的局部变量中，快速停止再启动时不会关闭新线程的循环
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
             
             try:
-                self.bridge_loop.run_until_complete(
-                    start_ble_midi_bridge(
-                        device_name=device_name,
-                        midi_port_name=midi_port,
-                        status_callback=self.status_callback,
-                        activity_callback=self.activity_callback
-                    )
-                )
+                loop.run_until_complete(bridge.run())
             except Exception as e:
                 self.status_callback(f"❌ 桥接器错误: {e}")
             finally:
-                if self.bridge_loop and not self.bridge_loop.is_closed():
-                    self.bridge_loop.close()
-                QTimer.singleShot(0, self.on_bridge_stopped)
+                loop.close()
+                # 已启动新的桥接器时不再重置UI状态
+                if self.bridge is None or self.bridge is bridge:
+                    QTimer.singleShot(0, self.on_bridge_stopped)
         
         self.bridge_thread = threading.Thread(target=run_bridge, daemon=True)
         self.bridge_thread.start()
@@ -277,6 +324,9 @@ class MainWindow(QMainWindow):
     
     def stop_bridge(self):
         """停止BLE桥接器"""
+        if self.bridge:
+            self.bridge.stop()
+            self.bridge = None
         self.is_running = False
         self.start_btn.setEnabled(True)
         self.stop_btn.setEnabled(False)
@@ -291,7 +341,11 @@ class MainWindow(QMainWindow):
     
     def closeEvent(self, event):
         """关闭窗口事件"""
+        bridge_thread = self.bridge_thread
         self.stop_bridge()
+        # 桥接线程是守护线程，等待它断开BLE连接后再退出，避免残留GATT会话
+        if bridge_thread and bridge_thread.is_alive():
+            bridge_thread.join(timeout=5.0)
         event.accept()
 
 def main():
@@ -302,14 +356,4 @@ def main():
     sys.exit(app.exec_())
 
 if __name__ == "__main__":
-    # 检查依赖
-    try:
-        import bleak
-        import mido
-        import PyQt5
-    except ImportError as e:
-        print(f"缺少依赖: {e}")
-        print("请安装: pip install bleak mido PyQt5 python-rtmidi")
-        sys.exit(1)
-    
     main()